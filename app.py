@@ -1,13 +1,23 @@
+import functools
+import logging
 import os
+import sqlite3
 from datetime import datetime, timezone, timedelta
+from typing import Optional
 
-import requests
+import httpx
+import orjson
+import tiktoken
 from dotenv import load_dotenv
 from flask import (
     Flask, render_template, redirect,
-    url_for, request, flash, jsonify
+    url_for, request, flash, jsonify,
+    Response, stream_with_context, session
 )
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from flask_login import (
     LoginManager, UserMixin, login_user,
     login_required, logout_user, current_user
@@ -17,9 +27,22 @@ from werkzeug.security import generate_password_hash, check_password_hash
 # 加载 .env 文件中的环境变量
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # ================== 基础配置 ==================
 
+class ORJSONProvider(JSONProvider):
+    """jsonify / request.get_json / SSE 消息的 JSON 编解码改用 orjson（比标准库 json 快几倍）"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # Flask 必需配置
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'change-this-secret-key')
@@ -30,6 +53,24 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db = SQLAlchemy(app)
 
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    SQLite 连接建立时的设置（连接池会复用连接，每个连接只执行一次）：
+    - WAL：写入时不阻塞读
+    - synchronous=NORMAL：WAL 模式下足够安全，少一次 fsync
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.close()
+
+
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'  # 未登录访问受保护页面会跳转到 login
 
@@ -40,50 +81,73 @@ GPT_BASE_URL = os.getenv('GPT_BASE_URL', 'https://aizex.top/v1')
 GPT_API_KEY = os.getenv('GPT_API_KEY', '')
 GPT_MODEL = os.getenv('GPT_MODEL', 'gpt-5')
 
-# 中国时区（UTC+8）
-CHINA_TZ = timezone(timedelta(hours=8))
+# 历史上下文按 token 预算截断：最多取最近 HISTORY_FETCH_LIMIT 条，总长度不超过 HISTORY_TOKEN_BUDGET
+HISTORY_FETCH_LIMIT = 100
+HISTORY_TOKEN_BUDGET = 6000
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoder():
+    """
+    第一次用到时才加载 tiktoken 编码表（需要联网下载，离线部署可预先放到 TIKTOKEN_CACHE_DIR）
+    加载失败返回 None，之后一直按字符数估算，不会每条消息都重新尝试下载
+    """
+    try:
+        return tiktoken.encoding_for_model('gpt-4o')
+    except Exception:
+        logger.warning("tiktoken encoding unavailable, counting characters instead", exc_info=True)
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(content: str) -> int:
+    """计算一条消息的 token 数；历史消息内容不会变，结果按内容缓存"""
+    enc = _get_encoder()
+    if enc is None:
+        # 中文大致一个字一个 token，用字符数粗略估计
+        return len(content)
+    # encode_ordinary：消息里出现 <|endoftext|> 之类的文本时按普通文本计数，不会报错
+    return len(enc.encode_ordinary(content))
+
+# 全局复用一个 HTTP/2 客户端：多个并发的 GPT 请求共用同一条 TCP + TLS 连接（多路复用），
+# 不用每条消息都重新握手；连接失败时自动重试
+_GPT_CLIENT = httpx.Client(
+    base_url=GPT_BASE_URL.rstrip('/'),
+    headers={"Authorization": f"Bearer {GPT_API_KEY}"},
+    timeout=30,
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        retries=3,
+    ),
+)
+
+# 中国时区（UTC+8），固定偏移
+_CHINA_OFFSET = timedelta(hours=8)
+CHINA_TZ = timezone(_CHINA_OFFSET)
 
 
 def utc_to_china_time(utc_dt):
     """
     将UTC时间转换为中国时区时间（UTC+8）
-    处理SQLAlchemy返回的naive datetime对象（假设它们是UTC时间）
+    写入时是带时区的 UTC 时间；SQLite 不保存时区，读回来是 naive 的 UTC 时间，两种都能直接处理：
+    UTC+8 没有夏令时，直接加 8 小时再标上时区即可，不用走 astimezone
     """
     if utc_dt is None:
         return None
-    try:
-        # SQLAlchemy返回的datetime对象通常是naive（没有时区信息）
-        # 我们假设数据库中存储的是UTC时间
-        if hasattr(utc_dt, 'tzinfo') and utc_dt.tzinfo is None:
-            # naive datetime，假设是UTC时间，添加UTC时区信息
-            utc_dt = utc_dt.replace(tzinfo=timezone.utc)
-        elif not hasattr(utc_dt, 'tzinfo'):
-            # 如果不是datetime对象，直接返回
-            return utc_dt
-        
-        # 转换到中国时区
-        return utc_dt.astimezone(CHINA_TZ)
-    except (AttributeError, TypeError, ValueError) as e:
-        # 如果转换失败，直接返回原时间（向后兼容）
-        print(f"Warning: Timezone conversion failed for {utc_dt}: {e}")
-        return utc_dt
-
-
-def call_gpt_api(messages):
+    return (utc_dt + _CHINA_OFFSET).replace(tzinfo=CHINA_TZ)
+
+
+def call_gpt_api(messages, cache_key=None):
     """
-    调用 GPT 兼容接口：
+    调用 GPT 兼容接口（流式）：
     - messages: OpenAI 风格的对话 [{"role": "...", "content": "..."}]
-    - 返回：字符串回复；如果失败返回一个简单提示。
+    - cache_key: 提示词缓存的分组键，开头内容相同的请求会复用服务端缓存
+    - 逐段 yield 模型生成的文本；如果失败 yield 一个简单提示。
     """
     if not GPT_API_KEY:
-        return "（后端提示：尚未配置 GPT_API_KEY，无法调用大模型。请联系管理员。）"
-
-    url = GPT_BASE_URL.rstrip('/') + "/chat/completions"
-
-    headers = {
-        "Authorization": f"Bearer {GPT_API_KEY}",
-        "Content-Type": "application/json",
-    }
+        yield "（后端提示：尚未配置 GPT_API_KEY，无法调用大模型。请联系管理员。）"
+        return
 
     payload = {
         "model": GPT_MODEL,
@@ -91,21 +155,42 @@ def call_gpt_api(messages):
         "temperature": 0.8,  # 稍高的温度，使回复更自然、更有人情味
         "top_p": 0.9,  # 核采样，增加回复的多样性
         "max_tokens": 500,  # 限制最大长度，保持回复简洁
+        "stream": True,  # 流式返回，用户能更快看到第一个字
     }
+    if cache_key:
+        payload["prompt_cache_key"] = cache_key
 
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
-        return data["choices"][0]["message"]["content"].strip()
-    except Exception as e:
-        # 打到后端日志里，方便调试
-        print("GPT API ERROR:", e)
-        return "（后端提示：调用大模型接口失败了，可以稍后再试，或联系管理员检查配置。）"
+        with _GPT_CLIENT.stream(
+            "POST", "/chat/completions",
+            content=orjson.dumps(payload),
+            headers={"Content-Type": "application/json"},
+        ) as resp:
+            resp.raise_for_status()
+            # SSE 格式：每行 "data: {...}"，最后一行是 "data: [DONE]"
+            for line in resp.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                choices = orjson.loads(data).get("choices") or []
+                if not choices:
+                    continue
+                content = (choices[0].get("delta") or {}).get("content")
+                if content:
+                    yield content
+    except Exception:
+        # 打到后端日志里（带堆栈），方便调试
+        logger.exception("GPT API error")
+        yield "（后端提示：调用大模型接口失败了，可以稍后再试，或联系管理员检查配置。）"
 
 
 # ================== 数据模型 ==================
 
+# 密码哈希算法：scrypt 走 OpenSSL 的 C 实现，比 pbkdf2（60 万次迭代）快得多
+PASSWORD_HASH_METHOD = 'scrypt'
+
 class User(UserMixin, db.Model):
     """
     用户表：
@@ -115,14 +200,20 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
 
     def set_password(self, password: str):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(
+            password, method=PASSWORD_HASH_METHOD, salt_length=16
+        )
 
     def check_password(self, password: str) -> bool:
         return check_password_hash(self.password_hash, password)
 
+    def needs_rehash(self) -> bool:
+        # 旧版本 Werkzeug 生成的 pbkdf2 哈希，登录成功后换成 scrypt
+        return not self.password_hash.startswith(PASSWORD_HASH_METHOD + ':')
+
 
 class Message(db.Model):
     """
@@ -132,6 +223,13 @@ class Message(db.Model):
     - created_at: 时间（用于显示日期:时:分）
     - is_bot: True 表示心理医生机器人说的，False 表示用户
     """
+    __table_args__ = (
+        # 按用户倒序翻页（键集分页）用的索引
+        db.Index('ix_msg_user_id_desc', 'user_id', db.desc('id')),
+        # 按用户取历史并按时间排序时直接走索引，不用再额外排序
+        db.Index('ix_msg_user_created', 'user_id', 'created_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(
         db.Integer,
@@ -140,53 +238,31 @@ class Message(db.Model):
     )
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(
-        db.DateTime,
-        default=datetime.utcnow,
+        db.DateTime(timezone=True),
+        default=lambda: datetime.now(timezone.utc),
         nullable=False
     )
     is_bot = db.Column(db.Boolean, default=False, nullable=False)
 
+    # messages 用 dynamic：current_user.messages 返回查询对象，可以直接排序/分页，不会一次性把全部记录读进内存
     user = db.relationship(
         'User',
-        backref=db.backref('messages', lazy=True)
+        backref=db.backref('messages', lazy='dynamic')
     )
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Flask-Login 每个请求只调用一次并缓存在 g 上；session.get 会先查 identity map
+    return db.session.get(User, int(user_id))
 
 
 
 # ================== 生成心理医生回复（调用 GPT） ==================
 
-def generate_psych_reply(user: User, user_text: str) -> str:
-    """
-    构造上下文 + system prompt，调用 GPT。
-    要求 GPT：
-    - 检测用户心情不好时要进行安慰
-    - 记住历史聊天内容
-    - 当用户问“之前说的啥”时，从历史中回顾回答
-    """
-    user_text = (user_text or "").strip()
-    if not user_text:
-        return "我好像没有听清楚，你可以再说一遍吗？"
-
-    # 取最近 N 条历史记录作为上下文
-    # 包括用户 + 机器人，按照时间从旧到新
-    # 增加历史记录数量以提供更好的上下文理解
-    history = (
-        Message.query
-        .filter_by(user_id=user.id)
-        .order_by(Message.created_at.asc())
-        .limit(40)  # 增加历史记录数量，提供更丰富的上下文
-        .all()
-    )
-
-    messages = []
-
-    # system 提示：在这里定义"心理医生"的角色、情绪安慰、记住历史等要求
-    system_prompt = """
+# system 提示：在这里定义"心理医生"的角色、情绪安慰、记住历史等要求
+# 模块加载时构造一次，每次请求直接复用；内容必须保持逐字节不变（不要拼接变量），服务端的提示词缓存才能命中
+SYSTEM_PROMPT = """
 你是一位专业、温暖、共情能力强的中文心理咨询师，正在通过文字与来访者进行在线心理咨询。
 
 核心原则：
@@ -230,22 +306,60 @@ def generate_psych_reply(user: User, user_text: str) -> str:
 
 请始终以专业、温暖、支持的态度陪伴来访者，帮助ta探索内心、缓解情绪、找到前进的方向。
 """
-    messages.append({"role": "system", "content": system_prompt})
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
 
-    # 把历史消息转换成 openai 风格 messages
-    for m in history:
-        role = "assistant" if m.is_bot else "user"
-        messages.append({
-            "role": role,
-            "content": m.content
-        })
 
-    # 当前用户输入
-    messages.append({"role": "user", "content": user_text})
+def load_history(user_id: int) -> list:
+    """
+    取最近的历史记录作为上下文（包括用户 + 机器人），返回 [(content, is_bot), ...]，从旧到新
+    从新到旧累加 token 数，超出预算就停，再翻回从旧到新的顺序
+    """
+    # 只取 content / is_bot 两列，返回普通元组，不用构造 ORM 对象
+    rows = db.session.execute(
+        db.select(Message.content, Message.is_bot)
+        .filter_by(user_id=user_id)
+        .order_by(Message.created_at.desc())
+        .limit(HISTORY_FETCH_LIMIT)
+    ).all()
+
+    history = []
+    used_tokens = 0
+    for content, is_bot in rows:
+        used_tokens += count_tokens(content)
+        if used_tokens > HISTORY_TOKEN_BUDGET:
+            break
+        history.append((content, is_bot))
+    history.reverse()
+    return history
+
+
+def generate_psych_reply_stream(user_id: int, user_text: str, history: Optional[list] = None):
+    """
+    构造上下文 + system prompt，流式调用 GPT，逐段 yield 回复内容。
+    - history: 调用方已经取好的历史记录（load_history 的返回值），不传则在这里查询
+    要求 GPT：
+    - 检测用户心情不好时要进行安慰
+    - 记住历史聊天内容
+    - 当用户问“之前说的啥”时，从历史中回顾回答
+    """
+    user_text = (user_text or "").strip()
+    if not user_text:
+        yield "我好像没有听清楚，你可以再说一遍吗？"
+        return
+
+    if history is None:
+        history = load_history(user_id)
+
+    # system 提示 + 历史消息（转换成 openai 风格 messages）+ 当前用户输入
+    messages = [
+        _SYSTEM_MSG,
+        *({"role": "assistant" if is_bot else "user", "content": content} for content, is_bot in history),
+        {"role": "user", "content": user_text},
+    ]
 
     # 调用 GPT
-    reply = call_gpt_api(messages)
-    return reply
+    # 同一用户的请求开头（system 提示 + 历史）基本一致，按用户分组命中提示词缓存
+    yield from call_gpt_api(messages, cache_key=f"psych:{user_id}")
 
 
 # ================== 路由：首页 / 注册 / 登录 / 登出 ==================
@@ -254,7 +368,10 @@ def generate_psych_reply(user: User, user_text: str) -> str:
 def index():
     if current_user.is_authenticated:
         return redirect(url_for('chat'))
-    return render_template('index.html')
+    # 有待显示的提示消息时才需要重新渲染，否则直接返回启动时渲染好的页面
+    if '_flashes' in session:
+        return render_template('index.html')
+    return Response(_INDEX_HTML, mimetype='text/html')
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -306,6 +423,10 @@ def login():
             flash('用户名或密码错误。', 'error')
             return redirect(url_for('login'))
 
+        if user.needs_rehash():
+            user.set_password(password)
+            db.session.commit()
+
         login_user(user)
         flash('登录成功。', 'success')
         return redirect(url_for('chat'))
@@ -321,6 +442,19 @@ def logout():
     return redirect(url_for('login'))
 
 
+# 未登录用户看到的首页内容是固定的，启动时渲染一次
+with app.test_request_context('/'):
+    _INDEX_HTML = render_template('index.html')
+
+
+@app.after_request
+def set_cache_headers(response):
+    # 登录 / 注册页带有提示消息，不允许浏览器或代理缓存
+    if request.endpoint in ('login', 'register'):
+        response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
 # ================== 路由：聊天 / 加载更多 / 删除消息 ==================
 
 @app.route('/chat', methods=['GET'])
@@ -329,40 +463,61 @@ def chat():
     """
     聊天页：
     - GET：显示最近 limit 条消息 + "加载更多"按钮
+    - ?before_id=xxx：只取 id 小于 before_id 的更早消息（"加载更多"用）
     """
-    # 默认显示最近 10 条，可以通过 ?limit=20,30... 加载更多
+    # 默认显示最近 10 条，可以通过 ?limit=20,30... 调整每次加载的条数
     limit = request.args.get('limit', 10, type=int)
     if limit < 5:
         limit = 5
-
-    total = Message.query.filter_by(user_id=current_user.id).count()
-    start = max(0, total - limit)
-
-    messages = (
-        Message.query
-        .filter_by(user_id=current_user.id)
-        .order_by(Message.created_at.asc())
-        .offset(start)
-        .limit(limit)
+    before_id = request.args.get('before_id', type=int)
+
+    # 键集分页：按 id 倒序走 (user_id, id) 索引，不用 offset 扫过再丢弃前面的行
+    query = Message.query.filter_by(user_id=current_user.id)
+    if before_id is not None:
+        query = query.filter(Message.id < before_id)
+
+    # 多取一条，用来判断是否还有更早的消息
+    rows = (
+        query
+        .order_by(Message.id.desc())
+        .limit(limit + 1)
         .all()
     )
-
-    has_more = limit < total
+    has_more = len(rows) > limit
+    messages = rows[:limit][::-1]
 
     return render_template(
         'chat.html',
         messages=messages,
         limit=limit,
         has_more=has_more,
+        before_id=messages[0].id if messages else None,
     )
 
 
+def serialize_message(msg: Message) -> dict:
+    """消息转成返回给前端的字典，时间转换为中国时区"""
+    return {
+        'id': msg.id,
+        'content': msg.content,
+        'created_at': utc_to_china_time(msg.created_at).strftime('%Y-%m-%d %H:%M'),
+        'is_bot': msg.is_bot
+    }
+
+
+def sse_event(event: str, data: dict) -> str:
+    """格式化一条 SSE 消息"""
+    return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+
 @app.route('/api/send_message', methods=['POST'])
 @login_required
 def send_message():
     """
-    API端点：异步发送消息并获取AI回复
-    返回JSON格式：{user_message: {...}, bot_message: {...}}
+    API端点：发送消息并以 SSE 流式返回AI回复
+    - event: delta  {content: "..."}  回复的一段文字
+    - event: done   {user_message: {...}, bot_message: {...}}  回复结束，消息已入库
+    - event: error  {error: "..."}
     """
     data = request.get_json()
     content = (data.get('message', '') or '').strip()
@@ -370,69 +525,74 @@ def send_message():
     if not content:
         return jsonify({'error': '消息内容不能为空'}), 400
 
+    # 先记下用户 id：下面 commit 之后 current_user 的属性会过期，再访问会重新查库、重新占用连接
+    user_id = current_user.id
+
     try:
-        # 1. 先保存用户说的话
-        user_msg = Message(
-            user_id=current_user.id,
-            content=content,
-            is_bot=False
-        )
-        db.session.add(user_msg)
+        # 历史记录在新消息入库之前取好（不含这条新消息），在响应开始前查完，出错能直接返回 500
+        history = load_history(user_id)
+        # 结束这次读事务，把连接还给连接池；否则整个 GPT 流式回复期间都会占着一个连接，
+        # gevent 下并发回复一多，后面的请求就要排队等连接
         db.session.commit()
+    except Exception:
+        db.session.rollback()
+        logger.exception("Error loading history")
+        return jsonify({'error': '发送消息时出错，请稍后再试'}), 500
 
-        # 2. 调用 GPT 生成心理医生回复
-        reply_text = generate_psych_reply(current_user, content)
+    # 1. 用户说的话先不入库，等回复生成完和机器人回复一起提交（只 commit 一次）
+    user_msg = Message(
+        user_id=user_id,
+        content=content,
+        created_at=datetime.now(timezone.utc),
+        is_bot=False
+    )
 
-        # 3. 保存机器人回复
-        bot_msg = Message(
-            user_id=current_user.id,
-            content=reply_text,
-            is_bot=True
-        )
-        db.session.add(bot_msg)
-        db.session.commit()
+    def generate():
+        try:
+            # 2. 调用 GPT 生成心理医生回复，边生成边推给前端
+            parts = []
+            for chunk in generate_psych_reply_stream(user_id, content, history):
+                parts.append(chunk)
+                yield sse_event('delta', {'content': chunk})
+
+            # 3. 流结束后把两条消息一起保存
+            bot_msg = Message(
+                user_id=user_id,
+                content=''.join(parts).strip(),
+                is_bot=True
+            )
+            db.session.add_all([user_msg, bot_msg])
+            db.session.commit()
+
+            yield sse_event('done', {
+                'user_message': serialize_message(user_msg),
+                'bot_message': serialize_message(bot_msg),
+            })
+        except Exception:
+            db.session.rollback()
+            logger.exception("Error sending message")
+            yield sse_event('error', {'error': '发送消息时出错，请稍后再试'})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
-        # 返回JSON格式的消息数据，时间转换为中国时区
-        user_time = utc_to_china_time(user_msg.created_at)
-        bot_time = utc_to_china_time(bot_msg.created_at)
-        
-        return jsonify({
-            'user_message': {
-                'id': user_msg.id,
-                'content': user_msg.content,
-                'created_at': user_time.strftime('%Y-%m-%d %H:%M') if user_time else user_msg.created_at.strftime('%Y-%m-%d %H:%M'),
-                'is_bot': False
-            },
-            'bot_message': {
-                'id': bot_msg.id,
-                'content': bot_msg.content,
-                'created_at': bot_time.strftime('%Y-%m-%d %H:%M') if bot_time else bot_msg.created_at.strftime('%Y-%m-%d %H:%M'),
-                'is_bot': True
-            }
-        })
-    except Exception as e:
-        db.session.rollback()
-        print(f"Error sending message: {e}")
-        return jsonify({'error': '发送消息时出错，请稍后再试'}), 500
+
+@functools.lru_cache(maxsize=4096)
+def _format_china_time(dt: datetime) -> str:
+    # 消息的 created_at 不会变，格式化结果可以直接缓存
+    return utc_to_china_time(dt).strftime('%Y-%m-%d %H:%M')
 
 
 # 注册Jinja2过滤器：将UTC时间转换为中国时区并格式化
 @app.template_filter('china_time')
 def china_time_filter(dt):
     """将UTC时间转换为中国时区并格式化为字符串"""
-    if dt:
-        try:
-            china_dt = utc_to_china_time(dt)
-            if china_dt:
-                return china_dt.strftime('%Y-%m-%d %H:%M')
-        except Exception as e:
-            print(f"Warning: Template time filter error: {e}")
-            # 如果转换失败，尝试直接格式化
-            try:
-                return dt.strftime('%Y-%m-%d %H:%M')
-            except:
-                return str(dt)
-    return ''
+    if not dt:
+        return ''
+    return _format_china_time(dt)
 
 
 @app.route('/delete_message/<int:message_id>', methods=['POST'])
@@ -442,20 +602,23 @@ def delete_message(message_id):
     删除任意一句话：
     - 只允许删除当前登录用户自己的消息（包括他自己的和机器人回给他的）
     """
-    msg = Message.query.get_or_404(message_id)
-    if msg.user_id != current_user.id:
-        # 检查是否是Ajax请求（通过Content-Type或Accept头判断）
-        wants_json = request.is_json or request.headers.get('Content-Type', '').startswith('application/json')
+    # 检查是否是Ajax请求（通过Accept头或JSON Content-Type判断），只算一次
+    wants_json = request.accept_mimetypes.best == 'application/json' or request.is_json
+
+    # 权限检查和删除合并成一条 DELETE：只会删掉属于当前用户的那条
+    result = db.session.execute(
+        db.delete(Message)
+        .where(Message.id == message_id, Message.user_id == current_user.id)
+    )
+    db.session.commit()
+
+    if result.rowcount == 0:
+        # 消息不存在，或者是别人的消息
         if wants_json:
-            return jsonify({'error': '你不能删除别人的消息。'}), 403
-        flash('你不能删除别人的消息。', 'error')
+            return jsonify({'error': '这条消息不存在，或者你不能删除别人的消息。'}), 404
+        flash('这条消息不存在，或者你不能删除别人的消息。', 'error')
         return redirect(url_for('chat'))
 
-    db.session.delete(msg)
-    db.session.commit()
-    
-    # 检查是否是Ajax请求
-    wants_json = request.is_json or request.headers.get('Content-Type', '').startswith('application/json')
     if wants_json:
         return jsonify({'success': True})
     flash('已删除这一条消息。', 'success')
@@ -464,10 +627,23 @@ def delete_message(message_id):
 
 # ================== 入口 ==================
 
+def init_db():
+    """建表；已有的库不会自动加新索引，这里顺便补上"""
+    db.create_all()
+    for index in Message.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """建表（用 gunicorn 部署时不会走下面的 __main__，需要先执行一次 flask --app app init-db）"""
+    init_db()
+
+
 if __name__ == '__main__':
     # 程序启动时建一次表
     with app.app_context():
-        db.create_all()
+        init_db()
 
     app.run(host='0.0.0.0', port=5000, debug=True)
 